@@ -1,14 +1,19 @@
+import functools
+import hashlib
 import json
 import os
+import re
 import time
+from collections import OrderedDict
 from pathlib import Path
 
-import ipyleaflet
-from openai import NotFoundError, OpenAI
-from openai.types.beta import Thread
+import msgspec
 
 import solara
 
+# openai and ipyleaflet are imported where they are used, to keep them (and their
+# dependencies) out of the worker until a page actually needs them
+
 HERE = Path(__file__).parent
 
 center_default = (0, 0)
@@ -17,12 +22,28 @@ zoom_default = 2
 messages = solara.reactive([])
 zoom_level = solara.reactive(zoom_default)
 center = solara.reactive(center_default)
-markers = solara.reactive([])
+markers = solara.reactive(())
+# text of the assistant message that is currently being streamed in
+pending = solara.reactive("")
 
-url = ipyleaflet.basemaps.OpenStreetMap.Mapnik.build_url()
-openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 model = "gpt-4-1106-preview"
-app_style = (HERE / "style.css").read_text()
+assistant_id = "asst_RqVKAzaybZ8un7chIwPCIQdH"
+
+css_comment_or_whitespace = re.compile(r"/\*.*?\*/|\s+", re.S)
+
+
+def minify_css(css: str) -> str:
+    # drops comments and collapses whitespace, our css has no strings where
+    # whitespace would matter
+    def replace(match):
+        return "" if match.group().startswith("/*") else " "
+
+    return css_comment_or_whitespace.sub(replace, css).strip()
+
+
+# minified once at import, since it is sent to the frontend with every page render
+app_style = minify_css((HERE / "style.css").read_text())
+message_window = 50
 
 
 # Declare tools for openai assistant to use
@@ -80,14 +101,29 @@ tools = [
 ]
 
 
-def update_map(longitude, latitude, zoom):
-    center.set((latitude, longitude))
-    zoom_level.set(zoom)
+class UpdateMapArgs(msgspec.Struct):
+    longitude: float
+    latitude: float
+    zoom: int
+
+
+class AddMarkerArgs(msgspec.Struct):
+    longitude: float
+    latitude: float
+    label: str
+
+
+# the map functions change a local copy of the map state, which is written back
+# to the reactive variables once all tool calls of a batch have run
+def update_map(args: UpdateMapArgs, map_state: dict):
+    map_state["center"] = (args.latitude, args.longitude)
+    map_state["zoom"] = args.zoom
     return "Map updated"
 
 
-def add_marker(longitude, latitude, label):
-    markers.set(markers.value + [{"location": (latitude, longitude), "label": label}])
+def add_marker(args: AddMarkerArgs, map_state: dict):
+    location = (args.latitude, args.longitude)
+    map_state["new_markers"].append({"location": location, "label": args.label})
     return "Marker added"
 
 
@@ -96,13 +132,101 @@ functions = {
     "add_marker": add_marker,
 }
 
+# decode the arguments of a tool call straight into the struct its function takes,
+# non-strict so that e.g. a zoom of 5.0 is still accepted
+decoders = {
+    "update_map": msgspec.json.Decoder(UpdateMapArgs, strict=False),
+    "add_marker": msgspec.json.Decoder(AddMarkerArgs, strict=False),
+}
+
+
+def _http_options():
+    # take the pool and timeout types from the SDK, since it may be built on a
+    # different httpx package than the one we could import ourselves
+    from openai import DEFAULT_CONNECTION_LIMITS, Timeout
+
+    Limits = type(DEFAULT_CONNECTION_LIMITS)
+    # the client is shared by all sessions, HTTP/2 lets its requests share a few
+    # long lived connections instead of doing a TLS handshake for each one
+    return dict(
+        http2=True,
+        limits=Limits(
+            max_connections=100, max_keepalive_connections=50, keepalive_expiry=300
+        ),
+        # fail fast when the API can't be reached, but give a run stream time
+        # between events while the model is thinking
+        timeout=Timeout(60.0, connect=3.0),
+    )
+
 
-def assistant_tool_call(tool_call):
+@functools.cache
+def _async_client():
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=DefaultAsyncHttpxClient(**_http_options()),
+    )
+
+
+# whether this process stored the tools on the assistant: None until it succeeded
+# (or failed permanently), False if the assistant can't be updated with our key
+tools_on_assistant = None
+
+
+async def run_tools():
+    # Returns the tools to pass to a run. Once they are stored on the assistant,
+    # runs don't need to send (and have validated) the full schemas every time.
+    # Note that this replaces any other tools configured on the (shared) assistant.
+    global tools_on_assistant
+    from openai import (
+        NOT_GIVEN,
+        APIError,
+        AuthenticationError,
+        NotFoundError,
+        PermissionDeniedError,
+    )
+
+    if tools_on_assistant is None:
+        try:
+            await _async_client().beta.assistants.update(assistant_id, tools=tools)
+        except (AuthenticationError, PermissionDeniedError, NotFoundError):
+            # E.g. a key that may run but not edit the assistant. This won't change,
+            # so don't keep adding a failing request to every run.
+            tools_on_assistant = False
+        except APIError:
+            # Connection errors, timeouts, rate limits and server errors may be
+            # transient, so we try again on the next run.
+            return tools
+        else:
+            tools_on_assistant = True
+    return NOT_GIVEN if tools_on_assistant else tools
+
+
+def assistant_tool_call(tool_call, map_state: dict):
     # actually executes the tool call the OpenAI assistant wants to perform
     function = tool_call.function
     name = function.name
-    arguments = json.loads(function.arguments)
-    return_value = functions[name](**arguments)
+    # problems are reported back to the assistant as the output instead of raising,
+    # which would leave the run waiting for tool outputs and block the thread
+    decoder = decoders.get(name)
+    if decoder is None:
+        # the (shared) assistant may have tools configured that we don't know
+        return_value = f"Unknown function: {name}"
+    else:
+        try:
+            if isinstance(function.arguments, dict):
+                # already parsed (e.g. by a newer SDK), only convert it to the struct
+                arguments = msgspec.convert(
+                    function.arguments, decoder.type, strict=False
+                )
+            else:
+                arguments = decoder.decode(function.arguments)
+        except msgspec.DecodeError as e:
+            # invalid or malformed arguments (ValidationError is a DecodeError)
+            return_value = f"Invalid arguments: {e}"
+        else:
+            return_value = functions[name](arguments, map_state)
     tool_outputs = {
         "tool_call_id": tool_call.id,
         "output": return_value,
@@ -110,18 +234,104 @@ def assistant_tool_call(tool_call):
     return tool_outputs
 
 
+def assistant_tool_calls(tool_calls):
+    # executes a batch of tool calls, and only updates the map once at the end
+    # instead of re-rendering it for every single call
+    map_state = {
+        "center": center.value,
+        "zoom": zoom_level.value,
+        "new_markers": [],
+    }
+    tool_outputs = [assistant_tool_call(tc, map_state) for tc in tool_calls]
+    center.set(map_state["center"])
+    zoom_level.set(map_state["zoom"])
+    # markers is an (immutable) tuple, extended once with all markers of the batch
+    if map_state["new_markers"]:
+        markers.set((*markers.value, *map_state["new_markers"]))
+    return tool_outputs
+
+
+# run events that end a run without completing it
+run_ended_events = (
+    "thread.run.failed",
+    "thread.run.expired",
+    "thread.run.cancelled",
+    "thread.run.incomplete",
+)
+
+
+# Responses to prompts we answered before, shared by all sessions so that a repeated
+# question (e.g. the same first question in a demo) does not go to the API again.
+# Maps a key to the time it was stored and the events of the run, in order:
+# ("tool_calls", [tool_call, ...]) or ("message", message)
+prompt_cache: OrderedDict = OrderedDict()
+prompt_cache_size = 512
+prompt_cache_ttl = 30 * 60
+
+
+def prompt_cache_key(history, value):
+    # history is the list of earlier prompts in the conversation
+    data = json.dumps({"a": assistant_id, "h": history, "q": value}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def prompt_cache_get(key):
+    entry = prompt_cache.get(key)
+    if entry is None:
+        return None
+    timestamp, events = entry
+    if time.monotonic() - timestamp > prompt_cache_ttl:
+        prompt_cache.pop(key, None)
+        return None
+    prompt_cache.move_to_end(key)
+    return events
+
+
+def prompt_cache_put(key, events):
+    prompt_cache[key] = (time.monotonic(), events)
+    prompt_cache.move_to_end(key)
+    while len(prompt_cache) > prompt_cache_size:
+        prompt_cache.popitem(last=False)
+
+
 @solara.component
 def Map():
+    import ipyleaflet
+
+    # the tile layer never changes, so we create its element only once and let
+    # the reconciler skip it when the markers, center or zoom change
+    tile_layer = solara.use_memo(
+        lambda: ipyleaflet.TileLayer.element(
+            url=ipyleaflet.basemaps.OpenStreetMap.Mapnik.build_url()
+        ),
+        dependencies=[],
+    )
+
+    def make_marker_data():
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [marker["location"][1], marker["location"][0]],
+                },
+                "properties": {"label": marker["label"]},
+            }
+            for marker in markers.value
+        ]
+        return {"type": "FeatureCollection", "features": features}
+
+    # all markers go into a single GeoJSON layer (leaflet draws points as markers),
+    # so we have one widget instead of one per marker, and we only rebuild its data
+    # when the markers change, not on center/zoom
+    marker_data = solara.use_memo(make_marker_data, dependencies=[markers.value])
     ipyleaflet.Map.element(  # type: ignore
         zoom=zoom_level.value,
         center=center.value,
         scroll_wheel_zoom=True,
         layers=[
-            ipyleaflet.TileLayer.element(url=url),
-            *[
-                ipyleaflet.Marker.element(location=k["location"], draggable=False)
-                for k in markers.value
-            ],
+            tile_layer,
+            ipyleaflet.GeoJSON.element(data=marker_data),
         ],
     )
 
@@ -129,13 +339,14 @@ def Map():
 @solara.component
 def ChatMessage(message):
     with solara.Row(style={"align-items": "flex-start"}):
+        # User prompts are sent along with the run, so we only keep them as a dict
+        if isinstance(message, dict) and message.get("role") == "user":
+            solara.Text(message["content"], style={"font-weight": "bold;"})
         # Catch "messages" that are actually tool calls
-        if isinstance(message, dict):
+        elif isinstance(message, dict):
             icon = "mdi-map" if message["output"] == "Map updated" else "mdi-map-marker"
             solara.v.Icon(children=[icon], style_="padding-top: 10px;")
             solara.Markdown(message["output"])
-        elif message.role == "user":
-            solara.Text(message.content[0].text.value, style={"font-weight": "bold;"})
         elif message.role == "assistant":
             if message.content[0].text.value:
                 solara.v.Icon(
@@ -184,71 +395,155 @@ def ChatBox(children=[]):
 @solara.component
 def ChatInterface():
     prompt = solara.use_reactive("")
-    run_id: solara.Reactive[str] = solara.use_reactive(None)
-
-    # Create a thread to hold the conversation only once when this component is created
-    thread: Thread = solara.use_memo(openai.beta.threads.create, dependencies=[])
+    # index in messages of the user prompt the assistant should respond to
+    prompt_index: solara.Reactive[int] = solara.use_reactive(None)
+
+    # id of the thread that holds the conversation, it is created by the first run
+    # so that the page does not wait for the API when it is rendered
+    thread_id = solara.use_ref(None)
+    # turns answered from the prompt cache that the thread has not seen yet, they
+    # are added to the thread together with the next prompt we send
+    unsent = solara.use_ref([])
+    # number of most recent messages that are rendered
+    window = solara.use_reactive(message_window)
 
     def add_message(value: str):
         if value == "":
             return
         prompt.set("")
-        new_message = openai.beta.threads.messages.create(
-            thread_id=thread.id, content=value, role="user"
-        )
-        messages.set([*messages.value, new_message])
-        # this creates a new run for the thread
-        # also also triggers a rerender (since run_id.value changes)
-        # which will trigger the poll function blow to start in a thread
-        run_id.value = openai.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id="asst_RqVKAzaybZ8un7chIwPCIQdH",
-            tools=tools,
-        ).id
-
-    def poll():
-        if not run_id.value:
+        messages.set([*messages.value, {"role": "user", "content": value}])
+        # this triggers a rerender (since prompt_index.value changes)
+        # which will trigger the stream_run coroutine below to start as a task
+        prompt_index.value = len(messages.value) - 1
+
+    async def stream_run():
+        if prompt_index.value is None:
+            return
+        pending.set("")
+        try:
+            await run_assistant(messages.value[prompt_index.value])
+        finally:
+            # don't leave a partial message behind when the run fails or is cancelled
+            pending.set("")
+
+    async def run_assistant(user_message):
+        history = [
+            m["content"]
+            for m in messages.value[: prompt_index.value]
+            if isinstance(m, dict) and m.get("role") == "user"
+        ]
+        cache_key = prompt_cache_key(history, user_message["content"])
+        cached_events = prompt_cache_get(cache_key)
+        if cached_events is not None:
+            unsent.current = [*unsent.current, user_message]
+            for kind, payload in cached_events:
+                if kind == "tool_calls":
+                    messages.set([*messages.value, *assistant_tool_calls(payload)])
+                else:
+                    messages.set([*messages.value, payload])
+                    text = "".join(
+                        c.text.value for c in payload.content if c.type == "text"
+                    )
+                    if text:
+                        unsent.current.append({"role": "assistant", "content": text})
             return
+        additional_messages = [*unsent.current, user_message]
+        if thread_id.current is None:
+            thread = await _async_client().beta.threads.create()
+            thread_id.current = thread.id
+        # opening the stream adds the prompt to the thread and creates the run in
+        # a single request, the server pushes events until the run either
+        # completes or pauses to ask for tool outputs
+        run_stream = _async_client().beta.threads.runs.stream(
+            thread_id=thread_id.current,
+            assistant_id=assistant_id,
+            tools=await run_tools(),
+            additional_messages=additional_messages,
+        )
+        # outputs of the tool calls we already ran, so a repeated requires_action
+        # for the same run doesn't add markers twice
+        submitted: dict[str, dict] = {}
+        # what happens in this run, to store in the prompt cache once it completes
+        events = []
         completed = False
-        while not completed:
-            try:
-                run = openai.beta.threads.runs.retrieve(
-                    run_id.value, thread_id=thread.id
-                )
-            # Above will raise NotFoundError when run creation is still in progress
-            except NotFoundError:
-                continue
-            if run.status == "requires_action":
-                tool_outputs = []
-                for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                    tool_output = assistant_tool_call(tool_call)
-                    tool_outputs.append(tool_output)
-                    messages.set([*messages.value, tool_output])
-                openai.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread.id,
-                    run_id=run_id.value,
-                    tool_outputs=tool_outputs,
-                )
-            if run.status == "completed":
-                messages.set(
-                    [
-                        *messages.value,
-                        openai.beta.threads.messages.list(thread.id).data[0],
-                    ]
-                )
-                run_id.set(None)
-                completed = True
-            time.sleep(0.1)
-
-    # run/restart a thread any time the run_id changes
-    result = solara.use_thread(poll, dependencies=[run_id.value])
+        while run_stream is not None:
+            async with run_stream as stream:
+                run_stream = None
+                # the stream is open, so the thread has the additional messages now
+                unsent.current = []
+                async for event in stream:
+                    if event.event == "thread.run.requires_action":
+                        run = event.data
+                        tool_calls = run.required_action.submit_tool_outputs.tool_calls
+                        new_calls = [tc for tc in tool_calls if tc.id not in submitted]
+                        new_outputs = assistant_tool_calls(new_calls)
+                        events.append(("tool_calls", new_calls))
+                        submitted.update((o["tool_call_id"], o) for o in new_outputs)
+                        messages.set([*messages.value, *new_outputs])
+                        tool_outputs = [submitted[tc.id] for tc in tool_calls]
+                        # all outputs are submitted at once, which continues the
+                        # same run in a new stream
+                        runs = _async_client().beta.threads.runs
+                        run_stream = runs.submit_tool_outputs_stream(
+                            thread_id=thread_id.current,
+                            run_id=run.id,
+                            tool_outputs=tool_outputs,
+                        )
+                    elif event.event == "thread.message.delta":
+                        for content in event.data.delta.content or []:
+                            if content.type == "text" and content.text:
+                                pending.set(pending.value + (content.text.value or ""))
+                    elif event.event == "thread.message.completed":
+                        messages.set([*messages.value, event.data])
+                        events.append(("message", event.data))
+                        pending.set("")
+                    elif event.event == "thread.run.completed":
+                        completed = True
+                    elif event.event in run_ended_events:
+                        # raise, so the failure shows up as the task's error
+                        run = event.data
+                        reason = run.last_error.message if run.last_error else ""
+                        raise RuntimeError(f"Assistant run {run.status}: {reason}")
+                    elif event.event == "error":
+                        raise RuntimeError(
+                            f"Assistant stream error: {event.data.message}"
+                        )
+        if completed:
+            prompt_cache_put(cache_key, events)
+
+    # run/restart the task any time a new message is added, the stream is only
+    # awaited, so we run it on the event loop instead of occupying a thread
+    task = solara.lab.use_task(
+        stream_run,
+        dependencies=[prompt_index.value],
+        raise_error=False,
+        prefer_threaded=False,
+    )
 
     # Create DOM for chat interface
     with solara.Column(classes=["chat-interface"]):
         if len(messages.value) > 0:
             with ChatBox():
-                for message in messages.value:
-                    ChatMessage(message)
+                # only render the last messages, so long conversations don't make
+                # every update slower, older messages are shown on request
+                start = max(0, len(messages.value) - window.value)
+                if start > 0:
+                    solara.Button(
+                        "Earlier messages...",
+                        text=True,
+                        on_click=lambda: window.set(window.value + message_window),
+                    ).key("earlier")
+                # ChatBox reverses the children, so without a key every message
+                # would shift position (and be re-rendered) when one is added
+                for i, message in enumerate(messages.value[start:], start):
+                    ChatMessage(message).key(f"message-{i}")
+                if pending.value:
+                    with solara.Row(style={"align-items": "flex-start"}).key("pending"):
+                        solara.v.Icon(
+                            children=["mdi-compass-outline"],
+                            style_="padding-top: 10px;",
+                        )
+                        solara.Markdown(pending.value)
 
         with solara.Column():
             solara.InputText(
@@ -258,11 +553,11 @@ def ChatInterface():
                 value=prompt,
                 style={"flex-grow": "1"},
                 on_value=add_message,
-                disabled=result.state == solara.ResultState.RUNNING,
+                disabled=task.pending,
             )
-            solara.ProgressLinear(result.state == solara.ResultState.RUNNING)
-            if result.state == solara.ResultState.ERROR:
-                solara.Error(repr(result.error))
+            solara.ProgressLinear(task.pending)
+            if task.error:
+                solara.Error(repr(task.exception))
 
 
 @solara.component